@@ -4,6 +4,7 @@ from google.cloud import bigquery
 from google.api_core import exceptions
 import argparse
 import gzip
+import hashlib
 import random
 import string
 import json
@@ -11,6 +12,17 @@ import uuid
 import time
 from datetime import datetime, timedelta
 
+# Refuse to run any query whose dry run says it will scan more than this
+# many bytes. Override with --max_bytes.
+MAX_BYTES_SCANNED = 1024 * 1024 * 1024
+
+# Estimated vs. actual bytes for every query get appended here, one JSON
+# record per line, so we can spot queries that start scanning more.
+SCAN_LOG_FILE = 'query_scan_log.json'
+
+# Warn if a query scans this many times more than it did last run.
+SCAN_REGRESSION_RATIO = 1.5
+
 def validate_credentials():
     """
 Check and see if we have a valid credentials file,
@@ -161,48 +173,227 @@ Insert rows of data into a BigQuery table.
     else:
         print("Inserted %s rows." % len(ROWS_TO_INSERT))
 
-def query_data_with_json(dataset_name, table_name):
+def partition_column(table):
+    """
+Find the column a table is partitioned on, and its type. Tables partitioned
+by ingestion time use the _PARTITIONTIME pseudo-column, tables partitioned
+on a column don't have one and have to be filtered on that column instead.
+Returns None if the table isn't partitioned.
+    """
+    if not table.partitioning_type:
+        return None
+    time_partitioning = table.time_partitioning
+    if time_partitioning and time_partitioning.field:
+        for field in table.schema:
+            if field.name == time_partitioning.field:
+                return (field.name, field.field_type)
+        return None
+    return ('_PARTITIONTIME', 'TIMESTAMP')
+
+def partition_filter(table, days):
+    """
+Build a WHERE clause limiting a query to the last N days of partitions.
+Returns an empty string if no day count was given, or if the table isn't
+partitioned, since filtering on the partition only saves bytes when it
+lets BigQuery skip partitions.
+    """
+    if not days:
+        return ""
+    column = partition_column(table)
+    if not column:
+        print("Note: %s isn't partitioned, scanning the whole table." %
+            table.table_id)
+        return ""
+    name, field_type = column
+    if field_type == 'DATE':
+        since = "DATE_SUB(CURRENT_DATE(), INTERVAL %d DAY)" % days
+    elif field_type == 'DATETIME':
+        since = "DATETIME_SUB(CURRENT_DATETIME(), INTERVAL %d DAY)" % days
+    else:
+        since = "TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL %d DAY)" % days
+    return "WHERE %s >= %s" % (name, since)
+
+def suggest_query_savings(query, table):
+    """
+Print some suggestions for making a query scan fewer bytes. BigQuery bills
+by the columns read, so whole structs and SELECT * are expensive, and
+partitioned tables are only cheap if you filter on the partition.
+    """
+    suggestions = []
+    normalized = ' '.join(query.upper().split())
+    if 'SELECT *' in normalized:
+        suggestions.append("Select only the columns you need instead of *.")
+    if 'TO_JSON_STRING(PAYLOAD)' in normalized:
+        suggestions.append("TO_JSON_STRING(payload) reads every payload "
+            "field, use --json_fields to pick just the ones you need.")
+    column = partition_column(table)
+    if column and column[0].upper() not in normalized:
+        suggestions.append("%s is partitioned, use --partition_days to "
+            "only scan recent partitions." % table.table_id)
+    for suggestion in suggestions:
+        print("Suggestion: %s" % suggestion)
+
+def estimate_query_bytes(client, query):
+    """
+Dry run a query to find out how many bytes it would scan, without
+actually running it or getting billed for it.
+    """
+    job_config = bigquery.job.QueryJobConfig()
+    job_config.dry_run = True
+    job_config.use_query_cache = False
+    query_job = client.query(query, job_config=job_config)
+    return query_job.total_bytes_processed
+
+def plan_query(client, query, table):
+    """
+Dry run a query before we run it for real. Prints any suggestions for
+reducing the scan, and returns the estimated bytes, or None if the query
+would scan more than MAX_BYTES_SCANNED.
+    """
+    suggest_query_savings(query, table)
+    estimated_bytes = estimate_query_bytes(client, query)
+    print("Estimated %s bytes to be processed." % estimated_bytes)
+    if estimated_bytes > MAX_BYTES_SCANNED:
+        print("Error: query would scan %s bytes, over the %s byte budget." %
+            (estimated_bytes, MAX_BYTES_SCANNED))
+        return None
+    return estimated_bytes
+
+def budgeted_job_config():
+    """
+A QueryJobConfig that makes BigQuery itself fail the query if it would bill
+more than MAX_BYTES_SCANNED, in case the dry run estimate was off.
+    """
+    job_config = bigquery.job.QueryJobConfig()
+    job_config.maximum_bytes_billed = MAX_BYTES_SCANNED
+    return job_config
+
+def read_scan_log():
+    "Read back all of the records in the scan log."
+    try:
+        with open(SCAN_LOG_FILE) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except IOError:
+        return []
+
+def scan_log_key(query_name, query):
+    """
+Key for a query in the scan log. Options like --json_fields change the SQL
+and how much it scans, so the key includes a hash of the query text to keep
+each variant's history separate.
+    """
+    normalized = ' '.join(query.split())
+    return "%s:%s" % (query_name, hashlib.md5(normalized).hexdigest()[:8])
+
+def record_query_bytes(query_name, query, estimated_bytes, actual_bytes,
+        cache_hit=False):
+    """
+Append the estimated and actual bytes for a query to the scan log, and
+warn if the query scanned a lot more than the last time it ran. Queries
+served from the cache report 0 bytes, so they're marked as cache hits and
+left out of the comparison.
+    """
+    key = scan_log_key(query_name, query)
+    previous = [r for r in read_scan_log()
+        if r.get('key') == key and not r.get('cache_hit')]
+    if previous and previous[-1]['actual_bytes'] and not cache_hit:
+        last_bytes = previous[-1]['actual_bytes']
+        if actual_bytes > last_bytes * SCAN_REGRESSION_RATIO:
+            print("Warning: %s scanned %s bytes, up from %s last run." %
+                (key, actual_bytes, last_bytes))
+    record = {'query': query_name,
+        'key': key,
+        'time': datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+        'estimated_bytes': estimated_bytes,
+        'actual_bytes': actual_bytes,
+        'cache_hit': cache_hit}
+    with open(SCAN_LOG_FILE, 'a') as f:
+        f.write(json.dumps(record)+"\n")
+
+def print_scan_log():
+    "Print the estimated vs. actual bytes for every query we've run."
+    records = read_scan_log()
+    if not records:
+        print("No queries recorded in %s." % SCAN_LOG_FILE)
+    for record in records:
+        print("%s\t%s\t%s\t%s%s" % (record['time'],
+            record.get('key', record['query']),
+            record['estimated_bytes'], record['actual_bytes'],
+            "\t(cached)" if record.get('cache_hit') else ""))
+
+def run_planned_query(client, query_name, query, table):
+    """
+Plan, run, and record a query. Returns the result rows, or None if the
+query was over budget.
+    """
+    estimated_bytes = plan_query(client, query, table)
+    if estimated_bytes is None:
+        return None
+    query_job = client.query(query, job_config=budgeted_job_config())
+    rows = list(query_job.result(timeout=30))
+    record_query_bytes(query_name, query, estimated_bytes,
+        query_job.total_bytes_processed, bool(query_job.cache_hit))
+    return rows
+
+def query_data_with_json(dataset_name, table_name, json_fields=None,
+        partition_days=None):
     """
 Run a SELECT statement against a BigQuery table and print the results.
 This variant uses the TO_JSON_STRING function to get back json of a struct.
+Pass json_fields to only read (and pay for) some of the payload fields.
     """
     client = bigquery.Client()
+    table = client.get_table(client.dataset(dataset_name).table(table_name))
+    if json_fields:
+        json_column = "TO_JSON_STRING(STRUCT(%s))" % ', '.join(
+            ['payload.%s' % field for field in json_fields])
+    else:
+        json_column = "TO_JSON_STRING(payload)"
     QUERY = """
-SELECT visit_id, visit_time, payload.visit_location, TO_JSON_STRING(payload)
-FROM `%s.%s.%s` ORDER BY visit_id LIMIT 100
-""" % (client.project, dataset_name, table_name)
-
-    rows = list(client.query_rows(QUERY, timeout=30))
+SELECT visit_id, visit_time, payload.visit_location, %s
+FROM `%s.%s.%s` %s ORDER BY visit_id LIMIT 100
+""" % (json_column, client.project, dataset_name, table_name,
+        partition_filter(table, partition_days))
+
+    rows = run_planned_query(client, 'query_data_with_json', QUERY, table)
+    if rows is None:
+        return
     for row in rows:
         print("%s\t%s\t%s\t%s" % (row[0], row[1], row[2], row[3]))
 
-def query_data_with_repeating_element(dataset_name, table_name):
+def query_data_with_repeating_element(dataset_name, table_name,
+        partition_days=None):
     """
 Run a SELECT statement against a BigQuery table and print the results.
 This variant uses sub-selects to get specific values out of the repeating
 records.
     """
     client = bigquery.Client()
+    table = client.get_table(client.dataset(dataset_name).table(table_name))
     QUERY = """
 SELECT visit_id, visit_time, payload.visit_location,
   (SELECT value FROM UNNEST(payload.metadata) WHERE key = "first_name")
     AS first_name,
   (SELECT value FROM UNNEST(payload.metrics) WHERE key = "net_promoter")
     AS net_promoter
-FROM `%s.%s.%s` ORDER BY visit_id LIMIT 100
-""" % (client.project, dataset_name, table_name)
+FROM `%s.%s.%s` %s ORDER BY visit_id LIMIT 100
+""" % (client.project, dataset_name, table_name,
+        partition_filter(table, partition_days))
 
-    rows = list(client.query_rows(QUERY, timeout=30))
+    rows = run_planned_query(client, 'query_data_with_repeating_element', QUERY, table)
+    if rows is None:
+        return
     for row in rows:
         print("%s\t%s\t%s\t%s\t%s" % (row[0], row[1], row[2], row[3], row[4]))
 
-def query_data_with_udf(dataset_name, table_name):
+def query_data_with_udf(dataset_name, table_name, partition_days=None):
     """
 Run a SELECT statement against a BigQuery table and print the results.
 This query uses an in-statement UDF to do some data processing with Javascript
 but you can also load JS libraries from Google Cloud Storage.
     """
     client = bigquery.Client()
+    table = client.get_table(client.dataset(dataset_name).table(table_name))
     QUERY = """
 CREATE TEMPORARY FUNCTION rot13(x STRING)
 RETURNS STRING
@@ -218,27 +409,36 @@ SELECT visit_id, visit_time, payload.visit_location,
     AS first_name,
   (SELECT value FROM UNNEST(payload.metrics) WHERE key = "net_promoter")
      AS net_promoter
-FROM `%s.%s.%s` ORDER BY visit_id LIMIT 100
-""" % (client.project, dataset_name, table_name)
+FROM `%s.%s.%s` %s ORDER BY visit_id LIMIT 100
+""" % (client.project, dataset_name, table_name,
+        partition_filter(table, partition_days))
 
-    rows = list(client.query_rows(QUERY, timeout=30))
+    rows = run_planned_query(client, 'query_data_with_udf', QUERY, table)
+    if rows is None:
+        return
     for row in rows:
         print("%s\t%s\t%s\t%s\t%s" % (row[0], row[1], row[2], row[3], row[4]))
 
-def query_data_into_table(dataset_name, source_table, dest_table):
+def query_data_into_table(dataset_name, source_table, dest_table,
+        partition_days=None):
     "Select data from a table into another table."
     client = bigquery.Client()
+    table = client.get_table(client.dataset(dataset_name).table(source_table))
     QUERY = """
 SELECT visit_id, visit_time, payload.visit_location,
   (SELECT value FROM UNNEST(payload.metadata) WHERE key = "first_name")
     AS first_name,
   (SELECT value FROM UNNEST(payload.metrics) WHERE key = "net_promoter")
     AS net_promoter
-FROM `%s.%s.%s`
-""" % (client.project, dataset_name, source_table)
+FROM `%s.%s.%s` %s
+""" % (client.project, dataset_name, source_table,
+        partition_filter(table, partition_days))
 
+    estimated_bytes = plan_query(client, QUERY, table)
+    if estimated_bytes is None:
+        return
     dataset = client.dataset(dataset_name)
-    job_config = bigquery.job.QueryJobConfig()
+    job_config = budgeted_job_config()
     job_config.destination = dataset.table(dest_table)
     job_config.write_disposition = 'WRITE_TRUNCATE'
     query_job = bigquery.job.QueryJob(str(uuid.uuid4()),
@@ -246,7 +446,12 @@ FROM `%s.%s.%s`
     query_job._begin()
     while not query_job.done():
         time.sleep(5)
+    if query_job.errors:
+        print(query_job.errors)
+        return
     print("%s bytes processed." % query_job.total_bytes_billed)
+    record_query_bytes('query_data_into_table', QUERY, estimated_bytes,
+        query_job.total_bytes_processed, bool(query_job.cache_hit))
 
 def extract_table_to_bucket(dataset_name, table, bucket_name):
     "Select data from a table into Google Cloud Storage."
@@ -412,8 +617,28 @@ if __name__ == '__main__':
     parser.add_argument('--load_table_from_bucket',
         help='Create a table from a Google Cloud Storage file',
         action="store")
+    parser.add_argument('--max_bytes',
+        help='Refuse to run queries that would scan more than this many bytes',
+        action="store", type=int, default=MAX_BYTES_SCANNED)
+    parser.add_argument('--json_fields',
+        help='Comma separated payload fields to return with --query_data_json',
+        action="store")
+    parser.add_argument('--partition_days',
+        help='Only query the last N days of partitions',
+        action="store", type=int)
+    parser.add_argument('--scan_log',
+        help='Show estimated vs. actual bytes scanned for past queries',
+        action="store_true")
     args = parser.parse_args()
 
+    # Set our per-query byte budget.
+    MAX_BYTES_SCANNED = args.max_bytes
+
+    # The scan log is a local file, so we don't need creds to show it.
+    if args.scan_log:
+        print_scan_log()
+        exit()
+
     # Make sure our creds are valid.
     validate_credentials()
 
@@ -443,13 +668,17 @@ if __name__ == '__main__':
         insert_data(table)
 
     elif args.query_data_json:
-        query_data_with_json('complex_dataset','complex_stream_table')
+        json_fields = args.json_fields.split(',') if args.json_fields else None
+        query_data_with_json('complex_dataset','complex_stream_table',
+            json_fields, args.partition_days)
 
     elif args.query_data_repeating:
-        query_data_with_repeating_element('complex_dataset','complex_stream_table')
+        query_data_with_repeating_element('complex_dataset','complex_stream_table',
+            args.partition_days)
 
     elif args.query_data_udf:
-        query_data_with_udf('complex_dataset','complex_stream_table')
+        query_data_with_udf('complex_dataset','complex_stream_table',
+            args.partition_days)
 
     elif args.generate_file:
         generate_file('complex_dataset.json.gz')
@@ -458,7 +687,8 @@ if __name__ == '__main__':
         load_data_from_file('complex_dataset','complex_stream_table','complex_dataset.json.gz')
 
     elif args.query_into_table:
-        query_data_into_table('complex_dataset','complex_stream_table','complex_query_output')
+        query_data_into_table('complex_dataset','complex_stream_table','complex_query_output',
+            args.partition_days)
 
     elif args.extract_table_to_bucket:
         extract_table_to_bucket('complex_dataset','complex_query_output',args.extract_table_to_bucket)
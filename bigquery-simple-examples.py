@@ -4,6 +4,10 @@ from google.cloud import bigquery
 from google.api_core import exceptions
 import argparse
 
+# Refuse to run any query whose dry run says it will scan more than this
+# many bytes. Override with --max_bytes.
+MAX_BYTES_SCANNED = 1024 * 1024 * 1024
+
 def validate_credentials():
     """
 Check and see if we have a valid credentials file,
@@ -108,6 +112,17 @@ Insert 6 rows of data into a BigQuery table.
     else:
         print("Inserted %s rows." % len(ROWS_TO_INSERT))
 
+def estimate_query_bytes(client, query):
+    """
+Dry run a query to find out how many bytes it would scan, without
+actually running it or getting billed for it.
+    """
+    job_config = bigquery.job.QueryJobConfig()
+    job_config.dry_run = True
+    job_config.use_query_cache = False
+    query_job = client.query(query, job_config=job_config)
+    return query_job.total_bytes_processed
+
 def query_data(dataset_name, table_name):
     """
 Run a SELECT statement against a BigQuery table and print the results.
@@ -120,7 +135,16 @@ ORDER BY full_name
 LIMIT 100
 """ % (client.project, dataset_name, table_name)
 
-    rows = list(client.query_rows(QUERY, timeout=30))
+    estimated_bytes = estimate_query_bytes(client, QUERY)
+    if estimated_bytes > MAX_BYTES_SCANNED:
+        print("Error: query would scan %s bytes, over the %s byte budget." %
+            (estimated_bytes, MAX_BYTES_SCANNED))
+        return
+
+    job_config = bigquery.job.QueryJobConfig()
+    job_config.maximum_bytes_billed = MAX_BYTES_SCANNED
+    query_job = client.query(QUERY, job_config=job_config)
+    rows = list(query_job.result(timeout=30))
     for row in rows:
         print("%s\t%s\t%s\t%s" % (row[0], row[1], row[2], row[3]))
 
@@ -159,8 +183,14 @@ if __name__ == '__main__':
     parser.add_argument('--query_data',
         help='Select some data from a table',
         action="store_true")
+    parser.add_argument('--max_bytes',
+        help='Refuse to run queries that would scan more than this many bytes',
+        action="store", type=int, default=MAX_BYTES_SCANNED)
     args = parser.parse_args()
 
+    # Set our per-query byte budget.
+    MAX_BYTES_SCANNED = args.max_bytes
+
     # Make sure our creds are valid.
     validate_credentials()
 